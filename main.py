@@ -1,14 +1,19 @@
 # main.py
-import os, ssl, json, time, base64, uuid, io, hmac, hashlib, sys
-from datetime import datetime, timedelta
+import os, ssl, json, time, uuid, io, hmac, hashlib, sys, asyncio, zlib, itertools, threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from datetime import datetime
 from zoneinfo import ZoneInfo
 
-from fastapi import FastAPI, Request, HTTPException, UploadFile, File, Form
+from fastapi import FastAPI, Request, HTTPException, UploadFile, File, Form, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import HTMLResponse, RedirectResponse, Response, PlainTextResponse
 from pydantic import BaseModel
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 from PIL import Image, ImageDraw, ImageFont
+import pybase64  # SIMD-base64 (AVX2/AVX-512), gleiche Ausgabe wie base64
 
 # ----------------- Konfiguration -----------------
 APP_API_KEY = os.getenv("API_KEY", "change_me")
@@ -20,10 +25,32 @@ MQTT_PASS   = os.getenv("MQTT_PASSWORD")
 MQTT_TLS    = os.getenv("MQTT_TLS", "true").lower() == "true"
 TOPIC       = os.getenv("PRINT_TOPIC", "print/tickets")
 PUBLISH_QOS = int(os.getenv("PRINT_QOS", "2"))   # QoS konfigurierbar (Default 2)
+# Binär: PNG roh statt base64-JSON (Firmware muss PRINT_TOPIC_BIN abonnieren)
+PRINT_BINARY = os.getenv("PRINT_BINARY", "false").lower() == "true"
+TOPIC_BIN    = os.getenv("PRINT_TOPIC_BIN", f"{TOPIC}/bin")
+# Nur mit PRINT_BINARY: Metadaten als MQTT-5-User-Properties statt JSON-Kopfzeile
+# (Payload = nur die Bilddaten; Broker und Firmware müssen MQTT 5 können)
+PRINT_BIN_PROPS = PRINT_BINARY and os.getenv("PRINT_BIN_PROPS", "false").lower() == "true"
+# 1-Bit-Rohbitmap (ESC/POS-Raster) statt PNG senden – binär oder base64 im JSON
+PRINT_RASTER = os.getenv("PRINT_RASTER", "false").lower() == "true"
+# JSON-Payload ab dieser Grösse (Bytes) zlib-komprimieren; 0 = aus (Firmware muss es können)
+PRINT_COMPRESS_MIN = int(os.getenv("PRINT_COMPRESS_MIN", "0"))
+PUBLISH_BATCH = int(os.getenv("PUBLISH_BATCH", "32"))  # max. Nachrichten pro Burst
+PUBLISH_QUEUE_MAX = int(os.getenv("PUBLISH_QUEUE_MAX", "100"))  # Back-Pressure: Requests warten, wenn voll
+PUBLISH_TIMEOUT = float(os.getenv("PUBLISH_TIMEOUT", "10"))  # max. Wartezeit auf Broker-Ack (s)
+# true: Request wartet, bis paho die Nachricht übernommen hat; false: zurück nach dem Einreihen
+PUBLISH_WAIT = os.getenv("PUBLISH_WAIT", "false").lower() == "true"
+# true: Text-Endpoints der API antworten sofort, Rendern + Senden läuft danach im Hintergrund
+PRINT_ASYNC = os.getenv("PRINT_ASYNC", "false").lower() == "true"
+# Parallele Broker-Verbindungen (je eigener paho-Thread); >1 garantiert keine Reihenfolge
+MQTT_CLIENTS = max(1, int(os.getenv("MQTT_CLIENTS", "1")))
+# Lang genug, dass der Broker eine ruhige Verbindung nicht abbaut (neuer TLS-Handshake)
+MQTT_KEEPALIVE = int(os.getenv("MQTT_KEEPALIVE", "300"))
 
 UI_PASS = os.getenv("UI_PASS", "set_me")
 COOKIE_NAME = "ui_token"
 UI_REMEMBER_DAYS = int(os.getenv("UI_REMEMBER_DAYS", "30"))
+UI_MAX_AGE = UI_REMEMBER_DAYS * 86400  # Sekunden
 TZ = ZoneInfo(os.getenv("TIMEZONE", "Europe/Zurich"))
 
 # Druckbreite: 72mm * 8 dpmm = 576 px (HS-830 Standard)
@@ -39,118 +66,396 @@ SIZE_BODY  = int(os.getenv("FONT_SIZE_BODY",  "28"))
 MARGIN_X = int(os.getenv("MARGIN_X", "20"))  # links/rechts
 MARGIN_Y = int(os.getenv("MARGIN_Y", "20"))  # oben
 EXTRA_BOTTOM = int(os.getenv("EXTRA_BOTTOM", "30"))  # etwas Luft am Ende
+LINE_GAP = int(os.getenv("LINE_GAP", "5"))  # Abstand zwischen Zeilen (px) über Ascent+Descent
+
+# zlib-Stufe für PNG (0-9); 1 = schnell, Grösse kaum relevant für s/w im LAN
+PNG_COMPRESS_LEVEL = int(os.getenv("PNG_COMPRESS_LEVEL", "1"))
+
+# Bild-Uploads nach s/w: "floyd" (Fehlerdiffusion, Fotos) oder "none" (harte Schwelle
+# bei 128 – schneller, gut für Screenshots/Text)
+IMAGE_DITHER = (Image.Dither.NONE if os.getenv("IMAGE_DITHER", "floyd").lower() == "none"
+                else Image.Dither.FLOYDSTEINBERG)
+
+# Uploads mit mehr Pixeln (Decompression-Bomb) abweisen; 0 = aus. Default grosszügig
+# für Handyfotos, aber weit unter Pillows 179 MP
+IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", "50000000")) or None
+# Pillows eigene Prüfung (warnt ab der Grenze, Fehler erst ab dem Doppelten) aus –
+# die Grenze prüft prepare_upload_image selbst
+Image.MAX_IMAGE_PIXELS = None
+
+# Threads für Rendern/Encodieren (CPU-gebunden; Pillow gibt dabei den GIL frei)
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(os.cpu_count() or 2)))
+
+# Anzahl fertig gerenderter Tickets im Speicher
+RENDER_CACHE_SIZE = int(os.getenv("RENDER_CACHE_SIZE", "256"))
 
 # ----------------- App & MQTT -----------------
 app = FastAPI(title="Printer API")
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
 
-client = mqtt.Client()
-if MQTT_TLS:
-    client.tls_set(cert_reqs=ssl.CERT_REQUIRED)
-if MQTT_USER or MQTT_PASS:
-    client.username_pw_set(MQTT_USER, MQTT_PASS)
-client.connect(MQTT_HOST, MQTT_PORT, 60)
-client.loop_start()
+# Ein TLS-Kontext für alle Clients: CA-Store nur einmal laden
+_TLS_CTX = ssl.create_default_context() if MQTT_TLS else None  # CERT_REQUIRED + Hostname-Check
+
+# Broker-Acks selbst verfolgen (on_publish kommt auch für Nachrichten, die paho
+# offline gepuffert und nach dem Reconnect gesendet hat). Schlüssel: (Client, mid)
+_ack_lock = threading.Lock()
+_acked: set[tuple[int, int]] = set()      # Ack da, Worker hat es noch nicht abgeholt
+_abandoned: set[tuple[int, int]] = set()  # Worker wartet nicht mehr; späteres Ack verwerfen
+
+def _on_publish(c, userdata, mid, reason_code=None, properties=None):
+    key = (id(c), mid)
+    with _ack_lock:
+        if key in _abandoned:
+            _abandoned.discard(key)
+        else:
+            _acked.add(key)
+
+def make_client() -> mqtt.Client:
+    c = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2,
+                    protocol=mqtt.MQTTv5 if PRINT_BIN_PROPS else mqtt.MQTTv311)
+    if _TLS_CTX:
+        c.tls_set_context(_TLS_CTX)
+    if MQTT_USER or MQTT_PASS:
+        c.username_pw_set(MQTT_USER, MQTT_PASS)
+    c.reconnect_delay_set(min_delay=1, max_delay=5)  # nach Abbruch schnell wieder da
+    c.max_queued_messages_set(PUBLISH_QUEUE_MAX)  # paho's Puffer (offline!) ebenfalls begrenzen
+    c.on_publish = _on_publish
+    return c
+
+# paho serialisiert Publishes pro Client über einen Lock; mehrere Clients
+# verteilen Bursts auf mehrere Sockets/Threads (Round-Robin)
+clients = [make_client() for _ in range(MQTT_CLIENTS)]
+_next_client = itertools.cycle(clients).__next__
+
+# Alle Publishes laufen über eine Queue; ein Worker sendet, was sich bei
+# gleichzeitigen Requests angestaut hat, am Stück statt einzeln. Der nächste
+# Burst startet erst nach dem Broker-Ack (max. PUBLISH_TIMEOUT). Ist paho's
+# Puffer voll (Broker länger weg), wartet der Worker, bis wieder Platz ist –
+# verworfen wird nichts. Dann füllt sich die Queue, und neue Requests bekommen
+# nach PUBLISH_TIMEOUT ein 503 statt eines "ok" für ein Ticket, das nie ankommt.
+_publish_q: asyncio.Queue = asyncio.Queue(maxsize=PUBLISH_QUEUE_MAX)
+
+async def mqtt_publish(topic: str, payload: bytes | str, properties: Properties | None = None):
+    """Reiht eine Nachricht ein (wartet nur, wenn die Queue voll ist).
+    Mit PUBLISH_WAIT zusätzlich, bis paho sie übernommen hat."""
+    fut = asyncio.get_running_loop().create_future() if PUBLISH_WAIT else None
+    try:
+        await asyncio.wait_for(_publish_q.put((topic, payload, properties, fut)), PUBLISH_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(503, "print queue full (MQTT broker unreachable?)")
+    if fut is not None:
+        await fut
+
+async def _publish_one(topic: str, payload: bytes | str, props: Properties | None) -> tuple[int, int]:
+    """client.publish mit Fehlerprüfung; gibt den Ack-Schlüssel zurück.
+    Bei vollem paho-Puffer wird ohne Frist gewartet, bis wieder Platz ist."""
+    c = _next_client()
+    full_logged = False
+    while True:
+        info = c.publish(topic, payload, qos=PUBLISH_QOS, retain=False, properties=props)
+        if info.rc != mqtt.MQTT_ERR_QUEUE_SIZE:
+            break
+        if not full_logged:
+            log("MQTT buffer full → waiting for broker")
+            full_logged = True
+        await asyncio.sleep(0.1)
+    # NO_CONN bei QoS 1/2: paho hat die Nachricht gepuffert und sendet sie nach dem Reconnect
+    if info.rc != mqtt.MQTT_ERR_SUCCESS and not (info.rc == mqtt.MQTT_ERR_NO_CONN and PUBLISH_QOS > 0):
+        raise RuntimeError(f"MQTT publish failed: {mqtt.error_string(info.rc)}")
+    return (id(c), info.mid)
+
+def _wait_published(keys: list[tuple[int, int]]):
+    # Auch offline bis zur Deadline warten – sonst liefe die Back-Pressure ins Leere
+    deadline = time.monotonic() + PUBLISH_TIMEOUT
+    while time.monotonic() < deadline:
+        with _ack_lock:
+            if _acked.issuperset(keys):
+                break
+        time.sleep(0.05)
+    with _ack_lock:
+        pending = [k for k in keys if k not in _acked]
+        _acked.difference_update(keys)
+        _abandoned.update(pending)  # paho sendet weiter; nur nicht mehr darauf warten
+    if pending:
+        log(f"MQTT ack timeout → {len(pending)} pending")
+
+async def _publish_worker():
+    while True:
+        batch = [await _publish_q.get()]
+        while len(batch) < PUBLISH_BATCH and not _publish_q.empty():
+            batch.append(_publish_q.get_nowait())
+        if len(batch) > 1:
+            log(f"MQTT batch → {len(batch)} messages")
+        keys = []
+        for topic, payload, props, fut in batch:
+            try:
+                keys.append(await _publish_one(topic, payload, props))
+            except Exception as e:
+                if fut is None:  # niemand wartet → hier loggen
+                    log("MQTT publish error:", repr(e))
+                elif not fut.done():
+                    fut.set_exception(e)
+            else:
+                if fut is not None and not fut.done():
+                    fut.set_result(None)
+        if keys:
+            await asyncio.to_thread(_wait_published, keys)
+        for _ in batch:  # erst nach den Acks erledigt → join() wartet auf Zustellung
+            _publish_q.task_done()
+
+# Eigener Pool: Render-Jobs verdrängen nicht AnyIOs Threadpool (sync-Endpoints,
+# Datei-I/O) und laufen höchstens zu RENDER_WORKERS gleichzeitig
+_render_pool = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix="render")
+
+async def run_render(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(_render_pool, partial(fn, *args, **kwargs))
+
+@app.on_event("startup")
+async def start_mqtt():
+    # Verbinden erledigt paho's Thread (inkl. Retries) – Start blockiert nicht und
+    # scheitert nicht, wenn der Broker gerade nicht erreichbar ist
+    for c in clients:
+        c.connect_async(MQTT_HOST, MQTT_PORT, MQTT_KEEPALIVE)
+        c.loop_start()
+
+@app.on_event("shutdown")
+async def stop_mqtt():
+    # Eingereihte Tickets sind dem Aufrufer schon bestätigt → vor dem Trennen senden
+    try:
+        await asyncio.wait_for(_publish_q.join(), PUBLISH_TIMEOUT)
+    except asyncio.TimeoutError:
+        log(f"MQTT shutdown: delivery not finished after {PUBLISH_TIMEOUT}s "
+            f"({_publish_q.qsize()} still queued, rest unacked)")
+    worker = getattr(app.state, "publish_worker", None)
+    if worker:
+        worker.cancel()
+    for c in clients:
+        c.disconnect()
+        c.loop_stop()
+
+@app.on_event("startup")
+async def start_publish_worker():
+    app.state.publish_worker = asyncio.create_task(_publish_worker())
 
 # ----------------- Helpers -----------------
 def log(*a):
     print("[printer]", *a, file=sys.stdout, flush=True)
 
-def now_str() -> str:
-    return datetime.now(TZ).strftime("%d.%m.%Y %H:%M")
+_now_cache = [-1, ""]  # (epoch-Minute, formatiert)
 
+def now_str() -> str:
+    m = int(time.time()) // 60
+    c = _now_cache
+    if c[0] != m:  # Format hat Minutenauflösung → strftime einmal pro Minute
+        c[1] = datetime.fromtimestamp(m * 60, tz=TZ).strftime("%d.%m.%Y %H:%M")
+        c[0] = m
+    return c[1]
+
+@lru_cache(maxsize=8)
+def font_file_bytes(path: str) -> bytes:
+    """TTF einmal komplett einlesen; FreeType arbeitet dann aus dem Speicher."""
+    with open(path, "rb") as f:
+        return f.read()
+
+@lru_cache(maxsize=8)
 def safe_load_font(path: str, size: int):
-    """Lädt TTF, fällt auf Default zurück (verhindert 500 bei fehlender Datei)."""
+    """Lädt TTF, fällt auf Default zurück (verhindert 500 bei fehlender Datei).
+    Gecacht pro (path, size) – die Datei wird nur einmal geparst."""
     try:
-        return ImageFont.truetype(path, size)
+        return ImageFont.truetype(io.BytesIO(font_file_bytes(path)), size)
     except Exception as e:
         log(f"Font load failed for {path}: {e}. Using default.")
         return ImageFont.load_default()
 
-def text_width(txt: str, font: ImageFont.ImageFont) -> int:
-    """Breite in Pixeln für gegebenen Text/Font (robust für neue Pillow-Versionen)."""
+@lru_cache(maxsize=4096)
+def text_length(txt: str, font: ImageFont.ImageFont) -> float:
+    """Vorschubbreite in Pixeln (float, damit sich Summen nicht verrunden).
+    Gecacht – Wörter und Titel wiederholen sich zwischen Tickets."""
     try:
         # Pillow 10+: FreeTypeFont.getlength
-        return int(font.getlength(txt))
+        return font.getlength(txt)
     except Exception:
         # Fallback über getbbox
         bbox = font.getbbox(txt)
         return bbox[2] - bbox[0]
 
+def text_width(txt: str, font: ImageFont.ImageFont) -> int:
+    """Breite in Pixeln für gegebenen Text/Font (robust für neue Pillow-Versionen)."""
+    return int(text_length(txt, font))
+
+# Druckbares ASCII + Latin-1 (Umlaute, ß) + übliche Typografie deutscher Texte
+_TABLE_CHARS = [chr(c) for c in (*range(32, 127), *range(160, 256))] + list("–—‚„“”‘’…€•")
+
+@lru_cache(maxsize=8)
+def advance_table(font: ImageFont.ImageFont) -> dict[str, float]:
+    """Vorschubbreite je Zeichen aus _TABLE_CHARS, einmal pro Font gemessen."""
+    return {ch: text_length(ch, font) for ch in _TABLE_CHARS}
+
+def word_length(word: str, font: ImageFont.ImageFont) -> float:
+    """Wortbreite für den Umbruch: bekannte Zeichen über die Tabelle (ohne
+    Kerning, Abweichung < 1 px), alles andere über FreeType."""
+    try:
+        return sum(map(advance_table(font).__getitem__, word))
+    except KeyError:
+        return text_length(word, font)
+
 def wrap_by_pixels(text: str, font: ImageFont.ImageFont, max_px: int) -> list[str]:
-    """Wortweises Umbrechen nach Pixelbreite."""
+    """Wortweises Umbrechen nach Pixelbreite.
+    Jedes Wort wird nur einmal gemessen; die Zeilenbreite läuft als Summe mit."""
     words = text.split()
     if not words:
         return [""]
+    # Schnellweg: die meisten Zeilen (Webhook, kurze Titel) passen ohne Umbruch
+    if len(words) == 1 or word_length(text, font) <= max_px:
+        return [" ".join(words)]
+    space_w = word_length(" ", font)
     lines = []
-    line = words[0]
+    parts = [words[0]]
+    line_w = word_length(words[0], font)
     for word in words[1:]:
-        test = f"{line} {word}"
-        if text_width(test, font) <= max_px:
-            line = test
+        word_w = word_length(word, font)
+        if line_w + space_w + word_w <= max_px:
+            parts.append(word)
+            line_w += space_w + word_w
         else:
-            lines.append(line)
-            line = word
-    lines.append(line)
+            lines.append(" ".join(parts))
+            parts = [word]
+            line_w = word_w
+    lines.append(" ".join(parts))
     return lines
 
-def pil_to_base64_png(img: Image.Image) -> str:
-    buf = io.BytesIO()
-    img = img.convert("1")  # s/w, Dithering
-    img.save(buf, format="PNG", optimize=True)
-    return base64.b64encode(buf.getvalue()).decode("ascii")
+# Einmal beim Start laden statt pro Request
+FONT_TITLE_OBJ = safe_load_font(FONT_TITLE, SIZE_TITLE)
+FONT_BODY_OBJ  = safe_load_font(FONT_BODY,  SIZE_BODY)
+
+@lru_cache(maxsize=8)
+def line_height(font) -> int:
+    """Zeilenhöhe aus den echten Font-Metriken (passt auch für den Fallback-Font)."""
+    ascent, descent = font.getmetrics()
+    return ascent + descent + LINE_GAP
 
-def mqtt_publish_image_base64(b64_png: str, cut_paper: int = 1,
-                              paper_width_mm: int = 0, paper_height_mm: int = 0):
-    payload = {
+def pil_to_png_bytes(img: Image.Image) -> bytes:
+    buf = io.BytesIO()
+    if img.mode != "1":
+        img = img.convert("1")  # s/w, Dithering
+    img.save(buf, format="PNG", optimize=False, compress_level=PNG_COMPRESS_LEVEL)
+    return buf.getvalue()
+
+def pil_to_raster_bytes(img: Image.Image) -> bytes:
+    """1 Bit/Pixel, MSB zuerst, 1 = schwarz, Zeilen auf volle Bytes aufgefüllt."""
+    if img.mode != "1":
+        img = img.convert("1")
+    return img.tobytes("raw", "1;I")
+
+def encode_image(img: Image.Image) -> bytes:
+    """Bild → Bytes im konfigurierten Format (PNG oder Rohbitmap)."""
+    return pil_to_raster_bytes(img) if PRINT_RASTER else pil_to_png_bytes(img)
+
+# Kompaktes JSON, Encoder einmal gebaut (json.dumps mit Optionen baut pro Aufruf einen neuen)
+_json_encode = json.JSONEncoder(separators=(",", ":")).encode
+
+def ticket_meta(cut_paper: int = 1, paper_width_mm: int = 0, paper_height_mm: int = 0) -> dict:
+    return {
         "ticket_id": f"web-{int(time.time()*1000)}-{uuid.uuid4().hex[:6]}",
         "data_type": "png",
-        "data_base64": b64_png,
         "paper_type": 0,
         "paper_width_mm": paper_width_mm,
         "paper_height_mm": paper_height_mm,
         "cut_paper": cut_paper
     }
+
+async def mqtt_publish_image_base64(b64_png: str | bytes, cut_paper: int = 1,
+                                    paper_width_mm: int = 0, paper_height_mm: int = 0, **meta):
+    """JSON-Envelope. base64 braucht kein JSON-Escaping, darum wird der (grosse)
+    String direkt angehängt statt durch den JSON-Encoder zu laufen."""
+    if isinstance(b64_png, str):
+        b64_png = b64_png.encode("ascii")
+    header = ticket_meta(cut_paper, paper_width_mm, paper_height_mm)
+    header.update(meta)
+    head = _json_encode(header)
+    data = b"".join((head[:-1].encode(), b',"data_base64":"', b64_png, b'"}'))
+    if PRINT_COMPRESS_MIN and len(data) > PRINT_COMPRESS_MIN:
+        data = zlib.compress(data, 1)  # erstes Byte 0x78 statt '{'
+    try:
+        log(f"MQTT publish → topic={TOPIC} qos={PUBLISH_QOS} bytes={len(data)}")
+        await mqtt_publish(TOPIC, data)
+    except Exception as e:
+        log("MQTT publish error:", repr(e))
+        raise
+
+async def mqtt_publish_image_bytes(data: bytes, cut_paper: int = 1,
+                                   paper_width_mm: int = 0, paper_height_mm: int = 0, **meta):
+    """Binär: eine JSON-Kopfzeile mit den Metadaten, dann die rohen Bilddaten.
+    Mit PRINT_BIN_PROPS stehen die Metadaten stattdessen in User-Properties."""
+    header = ticket_meta(cut_paper, paper_width_mm, paper_height_mm)
+    header.update(meta)
+    props = None
+    if PRINT_BIN_PROPS:
+        props = Properties(PacketTypes.PUBLISH)
+        props.UserProperty = [(k, str(v)) for k, v in header.items()]
+    else:
+        data = _json_encode(header).encode() + b"\n" + data
     try:
-        log(f"MQTT publish → topic={TOPIC} qos={PUBLISH_QOS} bytes={len(b64_png)}")
-        client.publish(TOPIC, json.dumps(payload), qos=PUBLISH_QOS, retain=False)
+        log(f"MQTT publish → topic={TOPIC_BIN} qos={PUBLISH_QOS} bytes={len(data)}")
+        await mqtt_publish(TOPIC_BIN, data, props)
     except Exception as e:
         log("MQTT publish error:", repr(e))
         raise
 
-def render_text_ticket(title: str, lines: list[str], add_datetime: bool = True) -> Image.Image:
-    font_title = safe_load_font(FONT_TITLE, SIZE_TITLE)
-    font_body  = safe_load_font(FONT_BODY,  SIZE_BODY)
+async def publish_image(data: bytes, width: int, cut_paper: int = 1):
+    """Sendet Bilddaten aus encode_image im konfigurierten Format."""
+    meta = {}
+    if PRINT_RASTER:
+        meta = {"data_type": "raw_bitmap", "width": width, "height": len(data) // ((width + 7) // 8)}
+    if PRINT_BINARY:
+        await mqtt_publish_image_bytes(data, cut_paper=cut_paper, **meta)
+    else:
+        await mqtt_publish_image_base64(pybase64.b64encode(data), cut_paper=cut_paper, **meta)
+
+@lru_cache(maxsize=64)  # wenige feste Titel ("TASKS", "MORGEN", …) → Umbruch einmal
+def wrap_title(title: str) -> tuple[str, ...]:
+    return tuple(wrap_by_pixels(title, FONT_TITLE_OBJ, PRINT_WIDTH_PX - 2 * MARGIN_X))
+
+# Häufige Titel schon beim Start vermessen
+for _t in ("TASKS", "TASK", "MORGEN"):
+    wrap_title(_t)
+
+def render_text_ticket(title: str, lines: list[str], add_datetime: bool = True,
+                       date_str: str | None = None) -> Image.Image:
+    font_title = FONT_TITLE_OBJ
+    font_body  = FONT_BODY_OBJ
 
     max_text_width = PRINT_WIDTH_PX - 2 * MARGIN_X
-    wrapped: list[tuple[str, str]] = []
+    wrapped: list[tuple[ImageFont.ImageFont, str]] = []
 
     # 1) Datum oben rechts reservieren
-    date_str = now_str() if add_datetime else None
+    if not add_datetime:
+        date_str = None
+    elif date_str is None:
+        date_str = now_str()
     date_block_height = 0
     if date_str:
-        date_block_height = SIZE_BODY + 10  # gleiche Zeilenhöhe wie Body
+        date_block_height = line_height(font_body)  # gleiche Zeilenhöhe wie Body
 
     # 2) Titel + Body wrap
     if title and title.strip():
-        for line in wrap_by_pixels(title.strip(), font_title, max_text_width):
-            wrapped.append(("title", line))
+        for line in wrap_title(title.strip()):
+            wrapped.append((font_title, line))
     for ln in lines:
         txt = (ln or "").strip()
         if not txt:
-            wrapped.append(("body", ""))  # Leerzeile erhalten
+            wrapped.append((font_body, ""))  # Leerzeile erhalten
             continue
         for line in wrap_by_pixels(txt, font_body, max_text_width):
-            wrapped.append(("body", line))
+            wrapped.append((font_body, line))
 
-    # 3) Höhe berechnen
-    line_h = SIZE_BODY + 10
-    num_lines = len(wrapped)
-    total_h = MARGIN_Y + date_block_height + (num_lines * line_h) + EXTRA_BOTTOM
-    total_h = max(total_h, 120)
+    # 3) Höhe berechnen (exakt, ohne Mindesthöhe – jede Zeile kostet PNG-Bytes)
+    total_h = MARGIN_Y + date_block_height + sum(line_height(f) for f, _ in wrapped) + EXTRA_BOTTOM
 
-    # 4) Zeichnen
-    img = Image.new("L", (PRINT_WIDTH_PX, total_h), color=255)
+    # 4) Zeichnen – bewusst frische Leinwand: eine wiederverwendete (leeren + crop)
+    # war gemessen nicht schneller, crop kopiert ohnehin. Direkt 1-Bit: Pillow rastert
+    # die Glyphen dann monochrom, kein L→1-Durchlauf nötig.
+    img = Image.new("1", (PRINT_WIDTH_PX, total_h), color=1)
     draw = ImageDraw.Draw(img)
 
     # Datum oben rechts
@@ -160,33 +465,88 @@ def render_text_ticket(title: str, lines: list[str], add_datetime: bool = True)
         draw.text((PRINT_WIDTH_PX - MARGIN_X - w, y), date_str, font=font_body, fill=0)
         y += date_block_height  # Platz nach Datum schaffen
 
-    # Text (linksbündig mit Rand)
-    for kind, txt in wrapped:
-        draw.text((MARGIN_X, y),
-                  txt,
-                  font=(font_title if kind == "title" else font_body),
-                  fill=0)
-        y += line_h
+    # Text (linksbündig mit Rand); Leerzeilen nur vorschieben
+    for font, txt in wrapped:
+        if txt:
+            draw.text((MARGIN_X, y), txt, font=font, fill=0)
+        y += line_height(font)
 
     return img
 
+@lru_cache(maxsize=RENDER_CACHE_SIZE)
+def _render_ticket_cached(title: str, lines: tuple[str, ...], date_str: str | None) -> bytes:
+    img = render_text_ticket(title, list(lines), add_datetime=date_str is not None, date_str=date_str)
+    return encode_image(img)
+
+# Laufende Renders: gleichzeitige identische Requests (Retries, Dashboard-Refresh)
+# warten auf denselben Job statt alle am LRU-Cache vorbei zu rendern.
+# Gedruckt wird trotzdem jedes Ticket – nur das Rendern wird geteilt.
+_inflight: dict[tuple, asyncio.Future] = {}
+
+async def render_ticket_async(title: str, lines: list[str], add_datetime: bool = True) -> bytes:
+    """Wie render_text_ticket + encode_image, gecacht und im Render-Pool.
+    Das Datum (Minutenauflösung) ist Teil des Keys, bleibt also aktuell."""
+    key = (title, tuple(lines), now_str() if add_datetime else None)
+    fut = _inflight.get(key)
+    if fut is None:
+        fut = asyncio.ensure_future(run_render(_render_ticket_cached, *key))
+        _inflight[key] = fut
+        fut.add_done_callback(lambda _: _inflight.pop(key, None))
+    return await asyncio.shield(fut)  # Abbruch eines Wartenden stoppt den Job nicht
+
+def prepare_upload_image(fp) -> tuple[Image.Image, tuple[int, int]]:
+    """Upload (Dateiobjekt) → s/w in Druckbreite. Gibt (Bild, Originalgrösse) zurück."""
+    # Pillow liest direkt aus der gespoolten Upload-Datei, ohne Kopie als bytes
+    img = Image.open(fp)
+    orig_size = img.size
+    # Nur der Header ist gelesen, noch nichts dekodiert
+    if IMAGE_MAX_PIXELS and orig_size[0] * orig_size[1] > IMAGE_MAX_PIXELS:
+        raise Image.DecompressionBombError(
+            f"Image size ({orig_size[0] * orig_size[1]} pixels) exceeds limit of {IMAGE_MAX_PIXELS} pixels")
+    # JPEG: libjpeg dekodiert direkt verkleinert (1/2…1/8) und in Graustufen; sonst no-op
+    img.draft("L", (PRINT_WIDTH_PX, 1))
+    # Graustufen/1-Bit (Screenshots, nachgedruckte Bons) nicht nochmals kopieren
+    if img.mode not in ("L", "1"):
+        img = img.convert("L")
+    w, h = img.size
+    # Nur verkleinern (BOX = Flächenmittel, schnell und genug vor dem s/w-Dithering);
+    # schmale Bilder nicht hochskalieren
+    if w > PRINT_WIDTH_PX:
+        if img.mode == "1":
+            img = img.convert("L")  # "1" liesse sich nur NEAREST skalieren
+        img = img.resize((PRINT_WIDTH_PX, (h * PRINT_WIDTH_PX + w // 2) // w), Image.Resampling.BOX)
+    if img.mode == "1":
+        img.load()  # bereits s/w: fertig dekodieren, kein Dithering-Durchlauf
+        return img, orig_size
+    return img.convert("1", dither=IMAGE_DITHER), orig_size
+
+def encode_upload(fp) -> tuple[bytes, int, tuple[int, int]]:
+    """Upload → (Bytes, Breite, Originalgrösse) in einem Worker-Durchgang."""
+    img, orig_size = prepare_upload_image(fp)
+    return encode_image(img), img.width, orig_size
+
 # ----------------- Security -----------------
 def check_api_key(req: Request):
     key = req.headers.get("x-api-key") or req.query_params.get("key")
     if key != APP_API_KEY:
         raise HTTPException(401, "invalid api key")
 
+# Key-Schedule einmal berechnen; pro Token nur .copy() + update
+_HMAC_PROTO = hmac.new(APP_API_KEY.encode(), digestmod=hashlib.sha256)
+
+@lru_cache(maxsize=1024)  # Cookies präsentieren tagelang denselben ts
 def sign_token(ts: str) -> str:
-    sig = hmac.new(APP_API_KEY.encode(), ts.encode(), hashlib.sha256).hexdigest()[:32]
-    return f"{ts}.{sig}"
+    h = _HMAC_PROTO.copy()
+    h.update(ts.encode())
+    return f"{ts}.{h.hexdigest()[:32]}"
 
 def verify_token(token: str) -> bool:
     try:
         ts, _sig = token.split(".")
-        if sign_token(ts) != token:
+        if not hmac.compare_digest(sign_token(ts), token):  # konstante Laufzeit
             return False
-        created = datetime.fromtimestamp(int(ts), tz=TZ)
-        return (datetime.now(TZ) - created) < timedelta(days=UI_REMEMBER_DAYS)
+        # ts ist Epoch-Sekunden → Alter ohne datetime/Zeitzone berechnen
+        return (time.time() - int(ts)) < UI_MAX_AGE
     except Exception:
         return False
 
@@ -241,62 +601,68 @@ def health():
     )
 
 # ----------------- API -----------------
+async def print_ticket(title: str, lines: list[str], add_datetime: bool, cut_paper: int):
+    data = await render_ticket_async(title, lines, add_datetime=add_datetime)
+    await publish_image(data, PRINT_WIDTH_PX, cut_paper=cut_paper)
+
+async def _print_ticket_bg(*args):
+    try:
+        await print_ticket(*args)
+    except Exception as e:  # Antwort ist schon raus → nur loggen
+        log("background print error:", repr(e))
+
+async def submit_ticket(bg: BackgroundTasks, title: str, lines: list[str],
+                        add_datetime: bool = True, cut_paper: int = 1) -> dict:
+    """Mit PRINT_ASYNC nach der Antwort im Hintergrund drucken, sonst direkt."""
+    if PRINT_ASYNC:
+        bg.add_task(_print_ticket_bg, title, lines, add_datetime, cut_paper)
+        return {"ok": True, "queued": True}
+    await print_ticket(title, lines, add_datetime, cut_paper)
+    return {"ok": True}
+
 @app.get("/")
 def ok():
-    return {"ok": True, "topic": TOPIC, "qos": PUBLISH_QOS}
+    # Readiness: false, solange (noch) nicht alle Broker-Verbindungen stehen
+    return {"ok": all(c.is_connected() for c in clients), "topic": TOPIC, "qos": PUBLISH_QOS}
 
 @app.post("/print")
-async def print_job(p: PrintPayload, request: Request):
+async def print_job(p: PrintPayload, request: Request, bg: BackgroundTasks):
     check_api_key(request)
     log("API /print", p.model_dump())
-    img = render_text_ticket(p.title, p.lines, add_datetime=p.add_datetime)
-    b64 = pil_to_base64_png(img)
-    mqtt_publish_image_base64(b64, cut_paper=(1 if p.cut else 0))
-    return {"ok": True}
+    return await submit_ticket(bg, p.title, p.lines, p.add_datetime, cut_paper=(1 if p.cut else 0))
 
 @app.post("/webhook/print")
-async def webhook(request: Request):
+async def webhook(request: Request, bg: BackgroundTasks):
     check_api_key(request)
     data = await request.json() if "application/json" in (request.headers.get("content-type") or "") else {}
     text = data.get("text") or request.query_params.get("text")
     if not text:
         raise HTTPException(400, "text required")
     log("API /webhook/print", {"text": text})
-    img = render_text_ticket("TASK", [text], add_datetime=True)
-    b64 = pil_to_base64_png(img)
-    mqtt_publish_image_base64(b64, cut_paper=1)
-    return {"ok": True}
+    return await submit_ticket(bg, "TASK", [text])
 
 @app.post("/api/print/template")
-async def api_print_template(p: PrintPayload, request: Request):
+async def api_print_template(p: PrintPayload, request: Request, bg: BackgroundTasks):
     check_api_key(request)
     log("API /api/print/template", p.model_dump())
-    img = render_text_ticket(p.title, p.lines, add_datetime=p.add_datetime)
-    b64 = pil_to_base64_png(img)
-    mqtt_publish_image_base64(b64, cut_paper=(1 if p.cut else 0))
-    return {"ok": True}
+    return await submit_ticket(bg, p.title, p.lines, p.add_datetime, cut_paper=(1 if p.cut else 0))
 
 @app.post("/api/print/raw")
-async def api_print_raw(p: RawPayload, request: Request):
+async def api_print_raw(p: RawPayload, request: Request, bg: BackgroundTasks):
     check_api_key(request)
     log("API /api/print/raw", p.model_dump())
     lines = (p.text + (f"\n{now_str()}" if p.add_datetime else "")).splitlines()
-    img = render_text_ticket("", lines, add_datetime=False)
-    b64 = pil_to_base64_png(img)
-    mqtt_publish_image_base64(b64, cut_paper=1)
-    return {"ok": True}
+    return await submit_ticket(bg, "", lines, add_datetime=False)
 
 @app.post("/api/print/image")
 async def api_print_image(request: Request, file: UploadFile = File(...)):
     check_api_key(request)
-    content = await file.read()
-    img = Image.open(io.BytesIO(content)).convert("L")
-    w, h = img.size
-    if w != PRINT_WIDTH_PX:
-        img = img.resize((PRINT_WIDTH_PX, int(h * (PRINT_WIDTH_PX / w))))
-    b64 = pil_to_base64_png(img)
-    log("API /api/print/image", {"orig_size": (w, h), "sent_width": PRINT_WIDTH_PX, "bytes": len(b64)})
-    mqtt_publish_image_base64(b64, cut_paper=1)
+    try:
+        data, width, orig_size = await run_render(encode_upload, file.file)
+    except Image.DecompressionBombError:
+        raise HTTPException(413, "image too large")
+    log("API /api/print/image", {"orig_size": orig_size, "sent_width": width, "bytes": len(data)})
+    await publish_image(data, width, cut_paper=1)
     return {"ok": True}
 
 # ----------------- UI -----------------
@@ -373,7 +739,7 @@ HTML_PAGE = """
       <input type="password" name="pass" placeholder="falls noetig" />
       <label class="row"><input type="checkbox" name="remember"> Angemeldet bleiben</label>
     </div>
-    <small>Bild wird in s/w konvertiert und auf {w}px Breite skaliert.</small><br>
+    <small>Bild wird in s/w konvertiert und auf max. {w}px Breite verkleinert.</small><br>
     <button type="submit">Drucken</button>
   </form>
 </div>
@@ -387,14 +753,25 @@ HTML_PAGE = """
 </script>
 """.replace("{w}", str(PRINT_WIDTH_PX))
 
-def page(msg: str = "") -> HTMLResponse:
-    return HTMLResponse(HTML_PAGE.replace("{{MSG}}", msg))
+# Template einmal beim Start um {{MSG}} teilen und kodieren
+_HTML_PRE, _HTML_POST = (part.encode() for part in HTML_PAGE.split("{{MSG}}", 1))
+
+def page(msg: str | bytes = b"") -> HTMLResponse:
+    if isinstance(msg, str):
+        msg = msg.encode()
+    return HTMLResponse(_HTML_PRE + msg + _HTML_POST)
+
+# Feste Meldungen der Formular-Posts schon kodiert
+_MSG_SENT = '<div class="ok">Gesendet ✅</div>'.encode()
+_MSG_BAD_PASS = b'<div class="err">Falsches Passwort</div>'
+
+# GET /ui kennt nur zwei Varianten → komplette Seiten einmal vorab encodieren
+_UI_AUTHED = _HTML_PRE + '<div class="ok">Angemeldet ✅ – Passwortfeld kann leer bleiben.</div>'.encode() + _HTML_POST
+_UI_ANON = _HTML_PRE + '<div class="err">Nicht angemeldet – Passwort einmal eingeben oder "angemeldet bleiben" waehlen.</div>'.encode() + _HTML_POST
 
 @app.get("/ui", response_class=HTMLResponse)
 def ui(request: Request):
-    msg = '<div class="ok">Angemeldet ✅ – Passwortfeld kann leer bleiben.</div>' if require_ui_auth(request) \
-          else '<div class="err">Nicht angemeldet – Passwort einmal eingeben oder "angemeldet bleiben" waehlen.</div>'
-    return page(msg)
+    return HTMLResponse(_UI_AUTHED if require_ui_auth(request) else _UI_ANON)
 
 @app.get("/ui/logout")
 def ui_logout():
@@ -420,12 +797,12 @@ async def ui_print_template(
 ):
     authed, set_cookie = ui_handle_auth_and_cookie(request, pass_, remember)
     if not authed:
-        return page('<div class="err">Falsches Passwort</div>')
+        return page(_MSG_BAD_PASS)
     try:
-        img = render_text_ticket(title.strip(), [ln.strip() for ln in lines.splitlines()], add_datetime=add_dt)
-        b64 = pil_to_base64_png(img)
-        mqtt_publish_image_base64(b64, cut_paper=1)
-        resp = page('<div class="ok">Gesendet ✅</div>')
+        data = await render_ticket_async(title.strip(),
+                                         [ln.strip() for ln in lines.splitlines()], add_datetime=add_dt)
+        await publish_image(data, PRINT_WIDTH_PX, cut_paper=1)
+        resp = page(_MSG_SENT)
         if set_cookie: issue_cookie(resp)
         return resp
     except Exception as e:
@@ -443,13 +820,12 @@ async def ui_print_raw(
 ):
     authed, set_cookie = ui_handle_auth_and_cookie(request, pass_, remember)
     if not authed:
-        return page('<div class="err">Falsches Passwort</div>')
+        return page(_MSG_BAD_PASS)
     try:
         lines = (text + (f"\n{now_str()}" if add_dt else "")).splitlines()
-        img = render_text_ticket("", lines, add_datetime=False)
-        b64 = pil_to_base64_png(img)
-        mqtt_publish_image_base64(b64, cut_paper=1)
-        resp = page('<div class="ok">Gesendet ✅</div>')
+        data = await render_ticket_async("", lines, add_datetime=False)
+        await publish_image(data, PRINT_WIDTH_PX, cut_paper=1)
+        resp = page(_MSG_SENT)
         if set_cookie: issue_cookie(resp)
         return resp
     except Exception as e:
@@ -466,16 +842,11 @@ async def ui_print_image(
 ):
     authed, set_cookie = ui_handle_auth_and_cookie(request, pass_, remember)
     if not authed:
-        return page('<div class="err">Falsches Passwort</div>')
+        return page(_MSG_BAD_PASS)
     try:
-        content = await file.read()
-        img = Image.open(io.BytesIO(content)).convert("L")
-        w, h = img.size
-        if w != PRINT_WIDTH_PX:
-            img = img.resize((PRINT_WIDTH_PX, int(h * (PRINT_WIDTH_PX / w))))
-        b64 = pil_to_base64_png(img)
-        mqtt_publish_image_base64(b64, cut_paper=1)
-        resp = page('<div class="ok">Gesendet ✅</div>')
+        data, width, _ = await run_render(encode_upload, file.file)
+        await publish_image(data, width, cut_paper=1)
+        resp = page(_MSG_SENT)
         if set_cookie: issue_cookie(resp)
         return resp
     except Exception as e: